@@ -4,10 +4,11 @@
 """
 
 import logging
-from typing import List
+import struct
 from datetime import datetime, timezone, timedelta
 
 from . import rs485
+from .coordinator import HeatmiserCoordinator
 import voluptuous as vol
 
 from homeassistant.components.climate import (
@@ -23,18 +24,41 @@ from homeassistant.const import (
     CONF_ID,
     CONF_NAME,
     CONF_PORT,
+    CONF_SCAN_INTERVAL,
     UnitOfTemperature,
     PRECISION_WHOLE,
 )
 
+from homeassistant.core import callback
 import homeassistant.helpers.config_validation as cv
 _LOGGER = logging.getLogger(__name__)
 
 DOMAIN = "heatmiser_ndc"
 CONF_THERMOSTATS = "tstats"
 CONF_SERIALID = "serialid"
+CONF_MIN_FULL_INTERVAL = "min_full_interval"
 VERSION = "1.7.1"
 
+# dcb offset of the temperature for each sensor select value (dcb[13])
+# 0, 3 = built in sensor, 1, 4 = remote air sensor, 2 = floor sensor
+_SENSOR_OFFSETS = (32, 28, 30, 32, 28)
+
+# comfort settings - 4 x hours, mins, temp
+_COMFORT = struct.Struct('12B')
+_COMFORT_FORMAT = '{:02d}:{:02d} {}; {:02d}:{:02d} {}; {:02d}:{:02d} {}; {:02d}:{:02d} {};'
+
+_DAY_OF_WEEK = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+# 16 bit big endian dcb fields, decoded together from dcb[8]
+# cal offset (8-9), then hol hours, temp hold, remote air, floor & built in temps (24-33)
+_DCB_WORDS = struct.Struct('>H14x5H')
+
+# Default interval between reads of all stats, if scan_interval is not configured
+# (same as the climate domain default used before the coordinator)
+SCAN_INTERVAL = timedelta(seconds=60)
+# Default max secs before a stat is updated in Hass when only its clock has changed
+DEFAULT_MIN_FULL_INTERVAL = 60
+
 TSTAT_SCHEMA = vol.Schema(
     {vol.Required(CONF_ID): vol.Range(1, 32),
      vol.Required(CONF_NAME): cv.string, }
@@ -47,6 +71,7 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Optional(CONF_HOST): cv.string,
         vol.Optional(CONF_PORT): cv.port,
         vol.Optional(CONF_SERIALID): cv.string,
+        vol.Optional(CONF_MIN_FULL_INTERVAL, default=DEFAULT_MIN_FULL_INTERVAL): cv.positive_int,
         vol.Required(CONF_THERMOSTATS, default=[]): TSTATS_SCHEMA,
     }
 )
@@ -56,12 +81,13 @@ COMPONENT_SCHEMA = vol.Schema(
         vol.Optional(CONF_HOST): cv.string,
         vol.Optional(CONF_PORT): cv.port,
         vol.Optional(CONF_SERIALID): cv.string,
+        vol.Optional(CONF_MIN_FULL_INTERVAL, default=DEFAULT_MIN_FULL_INTERVAL): cv.positive_int,
         vol.Required(CONF_THERMOSTATS): TSTATS_SCHEMA,
     }
 )
 CONFIG_SCHEMA = vol.Schema({DOMAIN: COMPONENT_SCHEMA}, extra=vol.ALLOW_EXTRA)
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
 
     _LOGGER.info(f'Setting up platform: Domian {DOMAIN} Version {VERSION}')
 
@@ -70,15 +96,26 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     serialid = config.get(CONF_SERIALID)
     statlist = config[CONF_THERMOSTATS]
 
-    #Setup the RS485 serial interface
-    serial = rs485.HM_RS485(host, port, serialid)
+    #Setup the RS485 serial interface - opening the line blocks, so run in executor
+    serial = await hass.async_add_executor_job(rs485.HM_RS485, host, port, serialid)
+
+    # One coordinator reads all the stats in a single pass each scan interval
+    coordinator = HeatmiserCoordinator(
+        hass,
+        DOMAIN,
+        serial,
+        [stat[CONF_ID] for stat in statlist],
+        config.get(CONF_SCAN_INTERVAL, SCAN_INTERVAL),
+        config[CONF_MIN_FULL_INTERVAL],
+    )
 
-    # Add all entities - False in call means update is not called before adding
+    # Add all entities without waiting for the first read
     # because this slows down startup which generates warning message
     # However, entities are added with zero initial values
-    # These are soon updated after setup completes
-    
-    add_entities([HMV3Stat(stat,serial) for stat in statlist], False, )
+    # These are soon updated by the first refresh, started once setup completes
+
+    async_add_entities([HMV3Stat(coordinator, stat[CONF_ID], stat[CONF_NAME]) for stat in statlist])
+    hass.async_create_task(coordinator.async_refresh())
     _LOGGER.info("Platform setup complete")
 
 
@@ -86,44 +123,57 @@ class HMV3Stat(ClimateEntity):
     """Representation of a Heatmiser V3 PRT thermostat."""
 
     _attr_hvac_modes = [HVACMode.HEAT, HVACMode.OFF, HVACMode.AUTO]
+    _attr_preset_modes = ["Set time","Set UTC","Set time+offset"]
+    _attr_preset_mode = "Set time"
+    _attr_target_temperature_step = PRECISION_WHOLE
+    # TBD - max , min temps should be different if stat is in F not C
+    _attr_min_temp = 5
+    _attr_max_temp = 35
     _attr_supported_features = (
         ClimateEntityFeature.TARGET_TEMPERATURE
         | ClimateEntityFeature.TURN_OFF
         | ClimateEntityFeature.TURN_ON
         | ClimateEntityFeature.PRESET_MODE
     )
+    # Reads are done for all stats by the coordinator, which notifies the entity
+    _attr_should_poll = False
    
-    def __init__(self, device, rs485_line):
+    def __init__(self, coordinator, statno, name):
         
-        self._statno = device[CONF_ID]
-        self._name = device[CONF_NAME]
-        self.rs485 = rs485_line
-        #Allocate space and initialise dcb to 0. Necessary to avoid crash, if first read from stat fails 
-        self.dcb = [0] * 160
+        self._statno = statno
+        self._name = name
+        self.coordinator = coordinator
+        self.rs485 = coordinator.rs485
 
         # Maintain statistics for each stat. [0] = read, [1] = write
         self.rw_count =    [0,0]  #read/write count
         self.soft_errors = [0,0]  #CRC, NDR or other errors
         self.hard_errors = [0,0]  #if retries fail
 
+        # extra state attributes, rebuilt after each read or write
+        self._attrs_cache = None
+        # dcb last written to Hass, to skip updates where the coordinator kept the same dcb
+        self._last_dcb = None
+
         _LOGGER.info(f'Initialised stat {self._statno} = {self._name}')  
 
+    @property
+    def dcb(self):
+        # latest dcb read from the stat by the coordinator
+        return self.coordinator.data[self._statno]
+
     # local methods to help assemble the extra attributes
 
     def _get_day_and_time (self) :
-        _day_of_week = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-        return f'{_day_of_week[self.dcb[36]-1]} {self.dcb[37]:0>2d}:{self.dcb[38]:0>2d}:{self.dcb[39]:0>2d}' 
+        d = self.dcb
+        # stat day is 1-7 (Mon-Sun), but 0 before the first read
+        _day = _DAY_OF_WEEK[d[36]-1] if 1 <= d[36] <= 7 else '---'
+        return f'{_day} {d[37]:02d}:{d[38]:02d}:{d[39]:02d}'
 
     def _comfort_string (self, idx) :
         # returns comfort setting string with 4 entries in the form 
         # hh:mm tt, hh:mm tt, hh:mm tt, hh:mm tt,
-        _string = (
-            f'{self.dcb[idx]:0>2d}:{self.dcb[idx+1]:0>2d} {self.dcb[idx+2]}; '
-            f'{self.dcb[idx+3]:0>2d}:{self.dcb[idx+4]:0>2d} {self.dcb[idx+5]}; '
-            f'{self.dcb[idx+6]:0>2d}:{self.dcb[idx+7]:0>2d} {self.dcb[idx+8]}; '
-            f'{self.dcb[idx+9]:0>2d}:{self.dcb[idx+10]:0>2d} {self.dcb[idx+11]};'
-        )
-        return _string
+        return _COMFORT_FORMAT.format(*_COMFORT.unpack_from(self.dcb, idx))
         
     def _get_day_settings (self, dayno) :
         if self.dcb[16] == 0 :   # 5/2 mode
@@ -143,33 +193,34 @@ class HMV3Stat(ClimateEntity):
         # far fewer writes, so return "Count soft hard"
         return f'{self.rw_count[1]} {self.soft_errors[1]} {self.hard_errors[1]}'
 
-    @property
-    def extra_state_attributes(self) -> dict:
+    def _build_attrs(self) -> dict:
+        d = self.dcb
+        cal, hol, hold, remote, floor, builtin = _DCB_WORDS.unpack_from(d, 8)
         _result = {
-            "vendor id"          : self.dcb [2],
-            "version"            : self.dcb [3] & 0x7f,
-            "floor limit state"  : self.dcb [3] & 0x80,
-            "model"              : self.dcb [4],
-            "temp format"        : self.dcb [5],
-            "sw diff"            : self.dcb [6],
-            "cal offset"         : self.dcb[8] * 256 + self.dcb[9],
-            "output delay"       : self.dcb[10],
-            "address"            : self.dcb[11],
-            "up/down limit"      : self.dcb[12],
-            "sensor select"      : self.dcb[13],
-            "opt start"          : self.dcb[14],
-            "rate of change"     : self.dcb[15],
-            "program mode"       : self.dcb[16],
-            "floor limit"        : self.dcb[19],
-            "floor limit enable" : self.dcb[20],
-            "key lock"           : self.dcb[22],
-            "hol hours"          : self.dcb[24] * 256 + self.dcb[25],
-            "temp hold"          : self.dcb[26] * 256 + self.dcb[27],
-            "remote air temp"    : (self.dcb[28] * 256 + self.dcb[29])/10,
-            "floor temp"         : (self.dcb[30] * 256 + self.dcb[31])/10,
-            "built in temp"      : (self.dcb[32] * 256 + self.dcb[33])/10,
-            "error code"         : self.dcb[34],
-            "heat state"         : self.dcb[35],
+            "vendor id"          : d[2],
+            "version"            : d[3] & 0x7f,
+            "floor limit state"  : d[3] & 0x80,
+            "model"              : d[4],
+            "temp format"        : d[5],
+            "sw diff"            : d[6],
+            "cal offset"         : cal,
+            "output delay"       : d[10],
+            "address"            : d[11],
+            "up/down limit"      : d[12],
+            "sensor select"      : d[13],
+            "opt start"          : d[14],
+            "rate of change"     : d[15],
+            "program mode"       : d[16],
+            "floor limit"        : d[19],
+            "floor limit enable" : d[20],
+            "key lock"           : d[22],
+            "hol hours"          : hol,
+            "temp hold"          : hold,
+            "remote air temp"    : remote/10,
+            "floor temp"         : floor/10,
+            "built in temp"      : builtin/10,
+            "error code"         : d[34],
+            "heat state"         : d[35],
             "time"               : self._get_day_and_time(),
             "weekday"            : self._comfort_string (40),
             "weekend"            : self._comfort_string (52),
@@ -183,24 +234,28 @@ class HMV3Stat(ClimateEntity):
             "read stats"         : self._get_read_statistics(),
             "write stats"        : self._get_write_statistics(),
         } 
-        _LOGGER.debug(f'extra state attributes returning {_result}')
+        _LOGGER.debug('extra state attributes built %s', _result)
         return _result
 
+    @property
+    def extra_state_attributes(self) -> dict:
+        # dcb only changes when the coordinator reads it, so build the attributes once per read
+        if self._attrs_cache is None:
+            self._attrs_cache = self._build_attrs()
+        return self._attrs_cache
+
     @property
     def name(self):
-        _LOGGER.debug(f'name returning {self._name}')
         return self._name
 
     @property
     def unique_id(self):
-        _id = f"Heatmiser Prt {self._statno}"
-        _LOGGER.debug(f'unique_id returning {_id}')
-        return _id
+        return f"Heatmiser Prt {self._statno}"
         
     @property
     def temperature_unit(self):
         value = UnitOfTemperature.CELSIUS if (self.dcb[5] == 0) else UnitOfTemperature.FAHRENHEIT
-        _LOGGER.debug(f'temperature unit returning {value}')
+        _LOGGER.debug('temperature unit returning %s', value)
         return value
 
     @property
@@ -215,78 +270,51 @@ class HMV3Stat(ClimateEntity):
             value = HVACMode.AUTO
         else:
             value = HVACMode.HEAT
-        _LOGGER.debug(f'hvac mode returning {value}')
+        _LOGGER.debug('hvac mode returning %s', value)
         return value
 
-    @property
-    def target_temperature_step(self):
-        _LOGGER.debug(f'target temp step returning {PRECISION_WHOLE}')
-        return PRECISION_WHOLE
-
-    # TBD - max , min temps should be different if stat is in F not C
-    @property
-    def min_temp(self):
-        _LOGGER.debug(f'min temp returning 5')
-        return 5
-
-    @property
-    def max_temp(self):
-        _LOGGER.debug(f'max temp returning 35')
-        return 35
-
-    @property
-    def hvac_modes(self) -> List[str]:
-        result = self._attr_hvac_modes
-        _LOGGER.debug(f'hvac modes returning {result}')
-        return result
-
     @property
     def current_temperature(self):
     # Heatmiser stat has a floor and remote or builtin air sensor
     # Return the air sensor (builtin or remote) if present, otherwise floor sensor
 
-        senselect = self.dcb[13]
-        if senselect in [0, 3]:    # Built In sensor
-            idx = 32
-        elif senselect in [1, 4]:  # remote  air sensor
-            idx = 28
-        else:
-            idx = 30    # assume floor sensor
+        d = self.dcb
+        senselect = d[13]
+        idx = _SENSOR_OFFSETS[senselect] if senselect < 5 else 30    # assume floor sensor
 
-        value = (self.dcb[idx] * 256 + self.dcb[idx + 1])/10
+        value = ((d[idx] << 8) | d[idx + 1])/10
         
-        _LOGGER.debug(f'Current temperature returned {value}')
+        _LOGGER.debug('Current temperature returned %s', value)
         return (value)
 
     @property
     def target_temperature(self):
         temp = self.dcb[18]
-        _LOGGER.debug(f'Target temp returned {temp}')
+        _LOGGER.debug('Target temp returned %s', temp)
         return temp
-    
-    @property
-    def preset_modes(self):
-        return ["Set time","Set UTC","Set time+offset"]
-
-    @property
-    def preset_mode(self):
-        """Return the current preset mode."""
-        return "Set time"
 
     ######################################################
     # Now methods to write to the stat
 
-    def _write_to_stat (self, index, payload):
+    async def _async_write_to_stat (self, index, payload):
         #local method to call write stat and update statistics
-        _status, _errors = self.rs485.write_stat(self._statno, index, payload)
+        #the write blocks on the serial line, so run it in the executor
+        _status, _errors = await self.hass.async_add_executor_job(
+            self.rs485.write_stat, self._statno, index, payload)
         if _status != 0:
-            self.hard_errors [1] += 1
-        self.rw_count [1] +=1 
-        self.soft_errors [1] = self.soft_errors [1] + _errors 
-
-    def set_preset_mode(self, preset_mode):
+            self.hard_errors[1] += 1
+        else:
+            # show the new value now, rather than waiting for the next read
+            self.coordinator.patch_dcb(self._statno, index, payload)
+        self.rw_count[1] += 1
+        self.soft_errors[1] += _errors
+        self._attrs_cache = None  # write stats have changed
+        self.async_write_ha_state()
+        return _status
+
+    async def async_set_preset_mode(self, preset_mode):
         _LOGGER.info(f'set preset mode {preset_mode}')
-        _dt = 0
+        _dt = None
         if preset_mode == "Set time":
             _dt = datetime.now()  # regular local time
         elif preset_mode == "Set UTC":
@@ -295,46 +323,63 @@ class HMV3Stat(ClimateEntity):
             # special offset time to match clock on elec meter 
             _dt = datetime.now(timezone.utc) + timedelta(minutes=34, seconds =39)
 
-        if _dt != 0:
-            #_payload = [_dt.weekday(), _dt.hour, _dt.minute, _dt.second]
-            _payload = [23]  # test - set hour to 23
-            _LOGGER.info (f'writing time {_payload}')
-            #self._write_to_stat (36, _payload)
-            self._write_to_stat (37, _payload)
+        if _dt is None:
+            return
+
+        # day (1-7 = Mon-Sun), hours, mins, secs are consecutive in the dcb, so write all in one frame
+        _payload = [_dt.weekday() + 1, _dt.hour, _dt.minute, _dt.second]
+        _LOGGER.info (f'writing time {_payload}')
+        await self._async_write_to_stat (36, _payload)
     
-    def set_hvac_mode(self, hvac_mode):
+    async def async_set_hvac_mode(self, hvac_mode):
         # If Off , set stat to frost protect mode
         # If Heat or Auto, set stat to normal
-        _LOGGER.debug(f'set hvac mode to {hvac_mode}')
+        _LOGGER.debug('set hvac mode to %s', hvac_mode)
         _run_mode = 1 if hvac_mode == HVACMode.OFF else 0
-        self._write_to_stat (23, [_run_mode])
+        await self._async_write_to_stat (23, [_run_mode])
        
-    def turn_off(self):
-        _LOGGER.debug(f'turn off called')
-        self.set_hvac_mode(HVACMode.OFF)
+    async def async_turn_off(self):
+        _LOGGER.debug('turn off called')
+        await self.async_set_hvac_mode(HVACMode.OFF)
         
-    def turn_on(self):
-        _LOGGER.debug(f'turn on called')
-        self.set_hvac_mode(HVACMode.AUTO)
+    async def async_turn_on(self):
+        _LOGGER.debug('turn on called')
+        await self.async_set_hvac_mode(HVACMode.AUTO)
 
-    def set_temperature(self, **kwargs):
+    async def async_set_temperature(self, **kwargs):
         temp = kwargs.get(ATTR_TEMPERATURE)
-        _LOGGER.debug(f'Set target temp: {temp}')
+        _LOGGER.debug('Set target temp: %s', temp)
         temp = int(temp)
         if 35 >= temp >= 5:
-            self._write_to_stat(18, [temp])
+            await self._async_write_to_stat(18, [temp])
         
-    # Now method to refresh the whole dcb from the stat
+    # Now methods to pick up the dcb refreshed by the coordinator
 
-    def update(self):
-        _LOGGER.debug(f'Update started for {self._name}')
-        
-        _status,data,_errors = self.rs485.read_stat(self._statno)
-        if _status == 0:
-            self.dcb = data
-        else:
+    async def async_update(self):
+        # Only called by the update_entity service, as the entity is not polled
+        # Asks the coordinator to read all stats, which then notifies the entities
+        await self.coordinator.async_request_refresh()
+
+    async def async_added_to_hass(self):
+        await super().async_added_to_hass()
+        self.async_on_remove(
+            self.coordinator.async_add_listener(self._handle_coordinator_update))
+
+    @callback
+    def _handle_coordinator_update(self):
+        _LOGGER.debug('Update received for %s', self._name)
+
+        _status, _errors = self.coordinator.read_results[self._statno]
+        if _status != 0:
             self.hard_errors[0] += 1
         
-        self.rw_count[0] +=1 
-        self.soft_errors[0] = self.soft_errors[0] + _errors 
-        _LOGGER.debug(f'Update done for {self._name}')
+        self.rw_count[0] += 1
+        self.soft_errors[0] += _errors
+
+        # If the dcb is unchanged and the read was clean there is nothing new to show
+        # (read stats are then refreshed with the next change, at most min_full_interval later)
+        if self.dcb is self._last_dcb and _status == 0 and _errors == 0:
+            return
+        self._last_dcb = self.dcb
+        self._attrs_cache = None
+        self.async_write_ha_state()
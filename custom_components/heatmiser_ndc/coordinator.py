@@ -0,0 +1,81 @@
+"""
+  Update coordinator for the Heatmiser NDC component.
+  Reads the dcb of every stat on the RS485 line in one scheduled pass,
+  so entities share a single poll instead of each reading the line themselves
+"""
+
+import asyncio
+import logging
+import time
+
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator
+
+from . import rs485
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class HeatmiserCoordinator(DataUpdateCoordinator):
+    """Polls all stats on one RS485 line and caches their dcbs by stat number."""
+
+    def __init__(self, hass, name, rs485_line, statlist, update_interval, min_full_interval):
+        super().__init__(hass, _LOGGER, name=name, update_interval=update_interval)
+        self.rs485 = rs485_line
+        self.statlist = statlist
+        self.min_full_interval = min_full_interval
+        # Reads happen every update_interval, and when each read finishes varies from pass to pass,
+        # so allow half an interval of slack. The dcb is then replaced on the read nearest to
+        # min_full_interval after the last one (ie min_full_interval rounded to a whole number of reads)
+        self._full_threshold = min_full_interval - update_interval.total_seconds() / 2
+        self._lock = asyncio.Lock()
+
+        # Initialise every dcb to 0. Necessary to avoid crash, if first read from a stat fails
+        # Entities read from self.data, which is the same dict, so it is valid before the first refresh
+        # dcbs are bytes, as returned by the rs485 library
+        self.dcbs = {statno: bytes(160) for statno in statlist}
+        self.data = self.dcbs
+
+        # Result of the last read of each stat - (status, soft error count)
+        # Entities use this to keep their read statistics
+        self.read_results = {statno: (0, 0) for statno in statlist}
+
+        # When each dcb was last replaced (monotonic secs). -inf so the first read is always used
+        self._last_full = {statno: float('-inf') for statno in statlist}
+
+    def _only_clock_changed(self, statno, data):
+        # The stat's clock (dcb 36-39) ticks on every read, nothing else changes often
+        # Returns True if the new dcb is the same as the current one apart from the clock
+        old = self.dcbs[statno]
+        return data[:36] == old[:36] and data[40:] == old[40:]
+
+    def patch_dcb(self, statno, index, payload):
+        # Updates the cached dcb after a successful write of payload at index
+        old = self.dcbs[statno]
+        self.dcbs[statno] = old[:index] + bytes(payload) + old[index + len(payload):]
+
+    async def _async_update_data(self):
+        _LOGGER.debug('Coordinator update started for stats %s', self.statlist)
+
+        async with self._lock:
+            for statno in self.statlist:
+                try:
+                    status, data, errs = await self.hass.async_add_executor_job(
+                        self.rs485.read_stat, statno)
+                except Exception as err:
+                    # eg line could not be re-opened after a serial exception
+                    # count as a hard error for this stat, and carry on with the others
+                    _LOGGER.error(f'Read failed: stat= {statno} err= {err}')
+                    status, data, errs = -1, None, rs485.MAX_TRIES
+                now = time.monotonic()
+                if status == 0 and (
+                    now - self._last_full[statno] >= self._full_threshold
+                    or not self._only_clock_changed(statno, data)
+                ):
+                    self.dcbs[statno] = data
+                    self._last_full[statno] = now
+                # On a hard error, or if only the clock has moved, the previous dcb object is kept
+                # so entities can see nothing has changed and skip writing their state
+                self.read_results[statno] = (status, errs)
+
+        _LOGGER.debug('Coordinator update done')
+        return self.dcbs
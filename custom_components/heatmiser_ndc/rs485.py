@@ -4,49 +4,56 @@
 """
 # TBD check master addr = 129 or 160, does it matter?, what does touchpad use?
 
+import binascii
 import serial
 import logging
+import socket
+import struct
 import time
 import threading
 
-# use a semaphore to stop concurrent access to serial line.
-# Hass seems to call Update on multiple stats in sequence. However writes (to change setpoint or frost setting)
-# may occur in middle of a read, causing line errors (eg CRC)
-
-sema = threading.Semaphore(1)
-
 # Serial line attempts
 MAX_TRIES = 5
 
+# Max secs to wait for each read from the line. Replies are read by length, so this is
+# only waited in full on errors. A full dcb reply takes c0.33 sec at 4800 baud
+COM_TIMEOUT = 0.4
+# Max secs to wait for a frame to be written to the line
+WRITE_TIMEOUT = 0.5
+
+# Longest reply frame from a stat (read of whole dcb)
+MAX_REPLY = 159
+
+# Line speed, and the silence left between frames on the line - 3.5 chars of 10 bits
+BAUD_RATE = 4800
+FRAME_GAP = 3.5 * 10 / BAUD_RATE
+
+# Reply header - dest addr, frame length (lo, hi), source addr, func
+_HDR = struct.Struct('<BHBB')
+# crc as sent on the line, lo byte first
+_CRC = struct.Struct('<H')
+# Command header - dest addr, frame length, source addr, func, start index, byte count
+_CMD = struct.Struct('<BBBBHH')
+
 _LOGGER = logging.getLogger(__name__)
 
+def _crc(message):
+    # CRC (aka CCITT, poly 0x1021, msb first, initial value 0xffff) used by Heatmiser stats
+    # binascii.crc_hqx is the same CRC computed in C. message is bytes or bytearray
+    # Returns the 2 crc bytes (lo, hi) as sent on the line
+    return _CRC.pack(binascii.crc_hqx(message, 0xffff))
+
+
 class CRC16:
-    """CRC function (aka CCITT) used by Heatmiser stats"""
-    LookupHi = [ 0x00, 0x10, 0x20, 0x30, 0x40, 0x50, 0x60, 0x70,
-                 0x81, 0x91, 0xa1, 0xb1, 0xc1, 0xd1, 0xe1, 0xf1 ]
-    LookupLo = [ 0x00, 0x21, 0x42, 0x63, 0x84, 0xa5, 0xc6, 0xe7,
-                 0x08, 0x29, 0x4a, 0x6b, 0x8c, 0xad, 0xce, 0xef ]
-
-    def __init__(self):
-        self.hi = 0xff
-        self.lo = 0xff
-
-    def _extract_bits(self, val):
-        t = (self.hi >> 4) ^ val
-        self.hi = ((self.hi << 4) | (self.lo >> 4)) & 0xff
-        self.lo = (self.lo << 4) & 0xff 
-        # Do the table lookups and XOR the result into the CRC tables
-        self.hi = (self.hi ^ self.LookupHi[t]) & 0xff
-        self.lo = (self.lo ^ self.LookupLo[t]) & 0xff
-
-    def _update(self, val):
-        self._extract_bits(val >> 4)     # High nibble first
-        self._extract_bits(val & 0x0f)   # Low nibble
-
-    def run(self, message):
-        for value in message:
-            self._update(value)
-        return [self.lo, self.hi]
+    """CRC function (aka CCITT) used by Heatmiser stats
+       Kept for apps using the library directly, the library itself calls _crc
+    """
+
+    @staticmethod
+    def run(message):
+        # message may be a list, returns [lo, hi] crc bytes
+        # static, so both CRC16().run(msg) and CRC16.run(msg) work
+        return list(_crc(bytes(message)))
 
 
 class HM_RS485:
@@ -61,6 +68,12 @@ class HM_RS485:
         self.serialid = serialid
         self._initialize_serial()
 
+        # use a lock per line to stop concurrent access to the serial line.
+        # Reads are made in sequence. However writes (to change setpoint or frost setting)
+        # may occur in middle of a read, causing line errors (eg CRC)
+        # Separate lines (other HM_RS485 instances) don't block each other
+        self._lock = threading.Lock()
+
         # Maintain statistics for the line
         self.total      = 0 #total reads & writes
         self.crc_count  = 0 #crc errors - soft
@@ -68,6 +81,12 @@ class HM_RS485:
         self.oth_count  = 0 #Other errors - soft
         self.hard_count = 0 #if retries fail - hard
 
+        # read all command frames (with crc) by stat no, these never change so are built once
+        self._read_all_frames = {}
+
+        # time the last frame finished on the line, to keep the gap between frames
+        self._last_rx = 0.0
+
     def _initialize_serial(self):
         if (self.serialid is None) and self.ipaddress:
             _LOGGER.info(f'Initialising RS485 {self.ipaddress} : {self.port}')
@@ -77,20 +96,33 @@ class HM_RS485:
             self.serport = serial.Serial()
             self.serport.port = self.serialid
         else:
-            raise ValueError(f"Provide one of ipaddress and port or serialid, not both:\n ip: {ipaddress}, port: {port}: serialid: {serialid}") 
-        self.serport.baudrate = 4800
+            raise ValueError(f"Provide one of ipaddress and port or serialid, not both:\n ip: {self.ipaddress}, port: {self.port}: serialid: {self.serialid}") 
+        self.serport.baudrate = BAUD_RATE
         self.serport.bytesize = serial.EIGHTBITS
         self.serport.parity = serial.PARITY_NONE
         self.serport.stopbits = serial.STOPBITS_ONE
-        self.serport.timeout = 0.8
+        self.serport.timeout = COM_TIMEOUT
+        self.serport.write_timeout = WRITE_TIMEOUT  # so a wedged adaptor can't block a write for ever
         
         self.serport.close()  # just in case it was left open
         self.serport.open()
+        if self.ipaddress:
+            # The socket is kept open for all transactions, and only reopened after a SerialException
+            # Disable Nagle, so each command is sent as soon as it is written, not coalesced
+            # Keepalive, so a dead adaptor connection is detected rather than left half open
+            self.serport._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.serport._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         _LOGGER.debug("Serial port opened OK")
 
-    def _lohibytes(self, value):
-        # splits value into 2 bytes, returns lo, hi bytes
-        return value & 0xff, (value >> 8) & 0xff
+    def _read_reply(self):
+        # reads a reply frame from the stat. Bytes 1 & 2 of a frame hold its length (lo, hi),
+        # so read those first, then exactly the rest of the frame.
+        # Reading MAX_REPLY bytes would wait for the timeout on every reply shorter than that
+        data = self.serport.read(3)
+        if len(data) < 3:
+            return data   # _verify reports no data read
+        frame_len = min(max(data[2] * 256 + data[1], 3), MAX_REPLY)
+        return data + self.serport.read(frame_len - 3)
 
     def _verify(self, stat, datal):
         # verifies reply from stat by checking CRC and header fields, raises exception if error
@@ -103,55 +135,78 @@ class HM_RS485:
         
         #calculate and check the checksum
         rxmsg = datal[:length - 2]
-        crc = CRC16()
-        if crc.run(rxmsg) != datal[length - 2:]:
+        if _crc(rxmsg) != datal[length - 2:]:
             self.crc_count +=1
             raise ValueError(f'Bad CRC {length}')
         
-        dest = datal[0]
-        source = datal[3]
+        if length < _HDR.size:
+            self.oth_count +=1
+            raise ValueError("Length Error")
+
+        dest, frame_len, source, func = _HDR.unpack_from(datal)
         if (dest != 129 and dest != 160) or source != stat:
             self.oth_count +=1
             raise ValueError(f'Bad source/dest addr {source} {dest}')
         
-        func = datal[4]  # should be 0 read or 1 write
+        # func should be 0 read or 1 write
         if func != 1 and func != 0:
             self.oth_count +=1
             raise ValueError(f'Bad Func {func}')
         
-        frame_len = datal[2] * 256 + datal[1]
         if func == 1 and frame_len != 7 or length != frame_len:
             self.oth_count +=1
             raise ValueError("Length Error")
 
         # reply OK
 
-    def _send_read_check (self, stat, msg):
-        # sends message to stat, reads reply and checks it's ok
+    def _frame(self, msg):
+        # returns the message with its crc added, in one buffer ready to send with a single write
+        frame = bytearray(msg)
+        frame += _crc(frame)
+        return frame
+
+    def _send_read_check (self, stat, frame):
+        # sends frame (message + crc) to stat, reads reply and checks it's ok
         # common ode for both read and write
 
         _status = 0  # assume success
-        _reply = [0]
+        _reply = b''
         self.total +=1
         for _tries in range(MAX_TRIES):  # ie 0 to max_tries-1
             try:
-                _LOGGER.debug(f'sending to {stat}- len: {len(msg)} msg ={msg} tries ={_tries}')
+                if _LOGGER.isEnabledFor(logging.DEBUG):
+                    _LOGGER.debug('sending to %s- len: %d frame =%s tries =%d', stat, len(frame), list(frame), _tries)
                 
-                #Add crc and send to serial line
-                crc = CRC16()
-                string = bytes(msg + crc.run(msg))
-                self.serport.write(string)
+                # leave a gap after the last frame, so back to back frames don't run together
+                _gap = FRAME_GAP - (time.monotonic() - self._last_rx)
+                if _gap > 0:
+                    time.sleep(_gap)
+
+                #discard any stale bytes (eg rest of a bad reply), then send to serial line
+                self.serport.reset_input_buffer()
+                self.serport.write(frame)
                
                 # now read reply and check its ok
-                data = list(self.serport.read(159)) 
-                _LOGGER.debug(f'Reply: length {len(data)} Data = {data}')
+                # reply is kept as bytes - indexing bytes returns int, so no need to convert to list
+                data = self._read_reply()
+                self._last_rx = time.monotonic()
+                _LOGGER.debug('Reply: length %d Data = %s', len(data), data)
                 self._verify(stat, data)  # will raise exception if error
-                _LOGGER.debug(f'Reply OK')
+                _LOGGER.debug('Reply OK')
                 _reply = data[9:len(data)-2] # strip off header & crc
 
             except ValueError as err:
-                _LOGGER.info(f'Exception - stat {stat} = {err}')
-                time.sleep(0.1) # sleep, then retry
+                _LOGGER.info('Exception - stat %s = %s', stat, err)
+                # sleep, then retry. Back off - short after a single glitch, longer if the stat keeps failing
+                # kept small, as each failed try has usually waited COM_TIMEOUT already
+                time.sleep(min(0.1, 0.02 * (1 << _tries)))
+                continue
+
+            except serial.SerialTimeoutException as err:
+                # write timed out - line busy or adaptor slow, the port is still usable so just retry
+                # (must be caught before SerialException, which it is a subclass of)
+                self.oth_count +=1
+                _LOGGER.info('Write timeout - stat %s = %s', stat, err)
                 continue
 
             except serial.SerialException as err:
@@ -183,25 +238,25 @@ class HM_RS485:
         # writes the payload (a list of values) to the stat. index gives position in dcb
         # returns status, error count
 
-        with sema:
-            _LOGGER.info(f'write_stat- no, index, payload = {stat} {index} {payload}')
+        with self._lock:
+            _LOGGER.info('write_stat- no, index, payload = %s %s %s', stat, index, payload)
             
              #form command to write value to stat
-            startlo, starthi = self._lohibytes(index)
-            lengthlo, lengthhi = self._lohibytes(len(payload))
-            _command = [stat, 10+len(payload), 129, 1,
-                       startlo, starthi, lengthlo, lengthhi] + payload
-            _status, _reply, _errors = self._send_read_check (stat, _command )
+            _command = _CMD.pack(stat, 10+len(payload), 129, 1, index, len(payload)) + bytes(payload)
+            _status, _reply, _errors = self._send_read_check (stat, self._frame(_command))
         return _status, _errors
 
 
     def read_stat(self,stat): 
-        # reads the whole dcb from the stat, returns status, raw dcb, error count
+        # reads the whole dcb from the stat, returns status, raw dcb (bytes), error count
 
-        with sema:
-            _LOGGER.debug(f'read_stat - {stat}')
+        with self._lock:
+            _LOGGER.debug('read_stat - %s', stat)
             
             # use standard read all command
-            _command = [stat, 10, 129, 0, 0, 0, 0xff, 0xff]
-            _status, _reply, _errors = self._send_read_check ( stat, _command )
+            _frame = self._read_all_frames.get(stat)
+            if _frame is None:
+                _frame = self._frame(_CMD.pack(stat, 10, 129, 0, 0, 0xffff))
+                self._read_all_frames[stat] = _frame
+            _status, _reply, _errors = self._send_read_check ( stat, _frame )
         return _status, _reply, _errors